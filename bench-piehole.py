@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+'''
+Benchmark piehole replication end to end.
+
+Every combination of member count, refs per push, concurrent pushers,
+push size and existing history gets its own repogroup.  Each run prints one JSON
+object per combination, with push-accept latency (how long "git push"
+takes to return), replication latency (how long until every member has
+the pushed commit) and throughput.  Consensus is kept in an in-process
+stand-in for the etcd keys API, so no etcd binary is needed.
+
+Run from a piehole checkout, like test-piehole.py.
+'''
+
+import argparse
+import http.server
+import importlib
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+
+sys.path.append('.')
+from piehole import run_git, GitFailure
+
+harness = importlib.import_module('test-piehole')
+TemporaryGitRepo = harness.TemporaryGitRepo
+TemporaryPieholeDaemon = harness.TemporaryPieholeDaemon
+cleanup_directory = harness.cleanup_directory
+in_directory = harness.in_directory
+run = harness.run
+
+REPLICATION_TIMEOUT = 120 # seconds
+REPLICATION_POLL = 0.05 # seconds between checks of the members' refs
+
+class EtcdStandIn(http.server.ThreadingHTTPServer):
+    '''
+    Just enough of the etcd keys API, as piehole's "etcd" backend uses
+    it, to run a benchmark in one process.  A "/" in a key makes a
+    directory, as it does in etcd.
+    '''
+    def __init__(self):
+        super(EtcdStandIn, self).__init__(('127.0.0.1', 0),
+                                          EtcdStandInHandler)
+        self.keys = {}
+        self.index = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+    def cleanup(self):
+        self.shutdown()
+        self.server_close()
+
+    def node(self, key):
+        with self.lock:
+            if key in self.keys:
+                return 200, {'action': 'GET', 'key': key,
+                             'value': self.keys[key], 'index': self.index}
+            children = {}
+            start = key.rstrip('/') + '/'
+            for name, value in self.keys.items():
+                if not name.startswith(start):
+                    continue
+                child = name[len(start):].split('/')[0]
+                if name == start + child:
+                    children[child] = {'action': 'GET', 'key': name,
+                                       'value': value, 'index': self.index}
+                else:
+                    children[child] = {'action': 'GET', 'key': start + child,
+                                       'dir': True, 'index': self.index}
+            if children:
+                return 200, [children[c] for c in sorted(children)]
+            return 404, {'errorCode': 100, 'message': 'Key Not Found',
+                         'cause': key}
+
+    def set(self, key, value, prev=None):
+        with self.lock:
+            old = self.keys.get(key)
+            if prev is not None and (old or '') != prev:
+                return 412, {'errorCode': 101, 'message': 'Test Failed',
+                             'cause': "[%s != %s]" % (prev, old)}
+            self.keys[key] = value
+            self.index += 1
+            result = {'action': 'SET', 'key': key, 'value': value,
+                      'index': self.index}
+            if old is None:
+                result['newKey'] = True
+            else:
+                result['prevValue'] = old
+            return 200, result
+
+class EtcdStandInHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def key(self, api):
+        path = urllib.parse.urlsplit(self.path).path
+        start = "/v1/%s/" % api
+        if not path.startswith(start):
+            return None
+        return '/' + urllib.parse.unquote(path[len(start):])
+
+    def reply(self, code, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-type', 'application/json; charset=utf-8')
+        self.send_header('Content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.key('keys') is not None:
+            self.reply(*self.server.node(self.key('keys')))
+        else:
+            self.reply(404, {'errorCode': 0, 'message': 'Not Found'})
+
+    def do_POST(self):
+        key = self.key('keys')
+        length = int(self.headers.get('content-length', 0))
+        params = urllib.parse.parse_qs(self.rfile.read(length).decode('utf-8'),
+                                       keep_blank_values=True)
+        if key is None or 'value' not in params:
+            self.reply(400, {'errorCode': 0, 'message': 'Bad Request'})
+            return
+        prev = params['prevValue'][0] if 'prevValue' in params else None
+        self.reply(*self.server.set(key, params['value'][0], prev))
+
+
+def summarize(samples):
+    "Median, 95th percentile and maximum of a list of seconds."
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    def at(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+    return {'median': at(0.5), 'p95': at(0.95), 'max': ordered[-1],
+            'count': len(ordered)}
+
+class Scenario:
+    '''
+    One repogroup with some members, and some work repos pushing
+    to them in turn.  Every repo starts with the same history commits
+    on a branch that the pushes build on, so that the cost of a big
+    repo shows up in the numbers.
+    '''
+    def __init__(self, etcdroot, consensus, members, refs, pushers, size,
+                 history=0):
+        self.members = members
+        self.refs = refs
+        self.pushers = pushers
+        self.size = size
+        self.history = history
+        self.repogroup = uuid.uuid4().hex
+        self.origin = TemporaryGitRepo('--bare')
+        if history:
+            self.make_history()
+        self.repos = []
+        for i in range(members):
+            repo = TemporaryGitRepo('--bare')
+            if history:
+                run_git('-C', self.origin.root, 'push', '--quiet', repo.url,
+                        'refs/heads/history')
+            with in_directory(repo):
+                run("piehole.py install --noseed --repogroup=%s "
+                    "--consensus=%s --etcdroot=%s" %
+                    (self.repogroup, consensus, etcdroot))
+            self.repos.append(repo)
+        self.workrepos = [TemporaryGitRepo() for i in range(pushers)]
+        if history:
+            for work in self.workrepos:
+                run_git('-C', work.root, 'fetch', '--quiet', self.origin.root,
+                        'refs/heads/history:refs/heads/history')
+                run_git('-C', work.root, 'checkout', '--quiet', '-B',
+                        'bench', 'history')
+
+    def make_history(self):
+        "Commit history small changes to one file, with git fast-import."
+        stream = []
+        for i in range(self.history):
+            message = b"history %d\n" % i
+            content = b"%d\n" % i
+            stream.append(b"commit refs/heads/history\n"
+                          b"committer piehole bench <bench@example.com> "
+                          b"%d +0000\n" % i)
+            stream.append(b"data %d\n%s" % (len(message), message))
+            stream.append(b"M 644 inline history\n")
+            stream.append(b"data %d\n%s\n" % (len(content), content))
+        subprocess.run(['git', '-C', self.origin.root, 'fast-import',
+                        '--quiet'], input=b''.join(stream), check=True)
+
+    def cleanup(self):
+        for repo in [self.origin] + self.repos + self.workrepos:
+            repo.cleanup()
+
+    def commit(self, pusher, round):
+        "Commit size bytes of new data, and return the commit's hash."
+        work = self.workrepos[pusher].root
+        filename = os.path.join(work, "data-%d" % round)
+        with open(filename, 'wb') as fh:
+            fh.write(os.urandom(self.size))
+        run_git('-C', work, 'add', filename)
+        run_git('-C', work, 'commit', '--quiet', "--message=round %d" % round)
+        return run_git('-C', work, 'rev-parse', 'HEAD').strip()
+
+    def branches(self, pusher):
+        return ["refs/heads/bench-%d-%d" % (pusher, i)
+                for i in range(self.refs)]
+
+    def replicated(self, pusher, commit):
+        "Whether every member has the commit, with one git call per member."
+        want = dict((ref, commit) for ref in self.branches(pusher))
+        for repo in self.repos:
+            res = run_git('-C', repo.root, 'for-each-ref',
+                          '--format=%(refname) %(objectname)',
+                          "refs/heads/bench-%d-*" % pusher)
+            have = dict(line.split(' ', 1) for line in res.splitlines())
+            if have != want:
+                return False
+        return True
+
+    def push(self, pusher, round, results):
+        "Push one round from one pusher and wait for it to replicate."
+        commit = self.commit(pusher, round)
+        target = self.repos[(pusher + round) % self.members]
+        refspecs = ["HEAD:%s" % ref for ref in self.branches(pusher)]
+        start = time.monotonic()
+        try:
+            run_git('-C', self.workrepos[pusher].root, 'push', '--quiet',
+                    target.url, *refspecs)
+        except GitFailure as err:
+            results['failed'] += 1
+            results['errors'].append(str(err)[-500:])
+            return
+        accepted = time.monotonic()
+        results['accept'].append(accepted - start)
+        deadline = accepted + REPLICATION_TIMEOUT
+        while not self.replicated(pusher, commit):
+            if time.monotonic() > deadline:
+                results['unreplicated'] += 1
+                return
+            time.sleep(REPLICATION_POLL)
+        results['replicate'].append(time.monotonic() - start)
+
+    def measure(self, rounds):
+        results = {'accept': [], 'replicate': [], 'failed': 0,
+                   'unreplicated': 0, 'errors': []}
+        def pusher_loop(pusher):
+            for round in range(rounds):
+                self.push(pusher, round, results)
+        threads = [threading.Thread(target=pusher_loop, args=(pusher,))
+                   for pusher in range(self.pushers)]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+        pushes = len(results['replicate'])
+        return {
+            'members': self.members,
+            'refs': self.refs,
+            'pushers': self.pushers,
+            'push_size': self.size,
+            'history': self.history,
+            'rounds': rounds,
+            'accept_latency': summarize(results['accept']),
+            'replication_latency': summarize(results['replicate']),
+            'pushes_per_second': pushes / elapsed,
+            'refs_per_second': pushes * self.refs / elapsed,
+            'bytes_per_second': pushes * self.size / elapsed,
+            'failed': results['failed'],
+            'unreplicated': results['unreplicated'],
+            'errors': results['errors'][:3],
+        }
+
+def numbers(text):
+    return [int(item) for item in text.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--members", type=numbers, default=[2, 3],
+                        help="comma-separated repogroup sizes")
+    parser.add_argument("--refs", type=numbers, default=[1, 10],
+                        help="comma-separated refs per push")
+    parser.add_argument("--pushers", type=numbers, default=[1, 4],
+                        help="comma-separated counts of concurrent pushers")
+    parser.add_argument("--size", type=numbers, default=[0, 1000000],
+                        help="comma-separated bytes of new data in each push")
+    parser.add_argument("--history", type=numbers, default=[0],
+                        help="comma-separated commits already in every repo")
+    parser.add_argument("--rounds", type=int, default=5,
+                        help="pushes per pusher in each scenario")
+    parser.add_argument("--consensus", choices=['etcd', 'local'],
+                        default='etcd',
+                        help="etcd uses the in-process stand-in")
+    parser.add_argument("--output",
+                        help="also append results to this file")
+    args = parser.parse_args()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    os.environ['PATH'] = "%s:%s" % (here, os.environ['PATH'])
+    for who in ('AUTHOR', 'COMMITTER'):
+        os.environ.setdefault("GIT_%s_NAME" % who, 'piehole bench')
+        os.environ.setdefault("GIT_%s_EMAIL" % who, 'bench@example.com')
+    scratch = tempfile.mkdtemp()
+    if args.consensus == 'etcd':
+        etcd = EtcdStandIn()
+        etcdroot = etcd.url
+    else:
+        etcd = None
+        etcdroot = os.path.join(scratch, 'consensus.db')
+    pieholed = TemporaryPieholeDaemon()
+    try:
+        for members, refs, pushers, size, history in itertools.product(
+                args.members, args.refs, args.pushers, args.size,
+                args.history):
+            scenario = Scenario(etcdroot, args.consensus,
+                                members, refs, pushers, size, history)
+            try:
+                result = scenario.measure(args.rounds)
+            finally:
+                scenario.cleanup()
+            result['consensus'] = args.consensus
+            result['git'] = run_git('--version').strip()
+            result['time'] = time.time()
+            line = json.dumps(result, sort_keys=True)
+            print(line)
+            sys.stdout.flush()
+            if args.output:
+                with open(args.output, 'a') as fh:
+                    fh.write(line + "\n")
+    finally:
+        pieholed.cleanup()
+        if etcd:
+            etcd.cleanup()
+        cleanup_directory(scratch)
+
+if __name__ == '__main__':
+    main()
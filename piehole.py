@@ -8,7 +8,10 @@ Replicate Git repositories using etcd.
 '''
 
 import argparse
+import base64
 import cgi
+import collections
+import contextlib
 from datetime import datetime
 import fcntl
 import filecmp
@@ -16,22 +19,55 @@ import http.server
 import json
 import locale
 import os
+import selectors
 import shutil
+import signal
 import socketserver
+import sqlite3
 import subprocess
 import sys
+import tempfile
 import time
 import urllib.parse
 import urllib.request
+import uuid
 
 GIT = '/usr/bin/git'
 CONFIG_PREFIX = 'piehole'
+CONSENSUS = 'etcd' # default backend, see CONSENSUS_BACKENDS
 ETCD_PREFIX = 'piehole'
 ETCD_ROOT = 'http://127.0.0.1:4001'
 DAEMON_PORT = 3690
+DAEMON_MAX_CHILDREN = 1000 # requests in progress, including queued transfers
 BLANK = '0000000000000000000000000000000000000000' # don't change
+GIT_TIMEOUT = 60 # seconds, for local git commands
+GIT_TRANSFER_TIMEOUT = 900 # seconds, for push and fetch to other members
+GIT_MAX_PROCS = 8 # network git commands running at once, per host
+GIT_SLOT_DIR = os.path.join(tempfile.gettempdir(), 'piehole-git-slots')
+GIT_NETWORK_COMMANDS = ('push', 'fetch', 'ls-remote', 'clone')
+GIT_TAIL_LINES = 100 # lines of streamed output kept for error messages
+GIT_PROGRESS_INTERVAL = 5 # seconds between logged progress updates
+TRANSFER_CLASSES = ('branch', 'fetch', 'bulk') # highest priority first
+REMOTE_TRANSFER_LIMIT = 2 # transfers running at once, per peer host
+SCHEDULER_AGING = 30 # seconds of waiting that raise a transfer one class
+SCHEDULER_RECHECK = 5 # seconds a waiting transfer sleeps without a wake-up
+SEED_TIMEOUT = 4 * 3600 # seconds, for the first fetch into a new member
+SEED_REFSPECS = ('+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*')
+REGISTRY_TTL = 300 # seconds to trust a served repo's config and sanity check
+PEER_REF_TTL = 60 # seconds to trust what a peer was last seen to have
+ETCD_V3_TXN_OPS = 128 # etcd's default --max-txn-ops
+CONFIG_KEYS = ('core.bare', 'core.logAllRefUpdates', 'etcdroot', 'etcdprefix',
+               'repourl', 'repogroup', 'consensus', 'state')
+CONFIG_CACHE = {}
 
 class GitFailure(Exception):
+    def __init__(self, message='', returncode=None, stdout='', stderr=''):
+        super(GitFailure, self).__init__(message)
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+
+class GitTimeout(GitFailure):
     pass
 
 class SanityCheckFailure(Exception):
@@ -54,12 +90,32 @@ def log(message='', to=sys.stdout, cache={}):
 def log_error(line):
     log(line, to=sys.stderr)
 
+def metric(name, to=None, cache={}, **fields):
+    "Append one JSON record to the metrics file, if there is one."
+    if to is not None:
+        cache['to'] = to
+    to = cache.get('to')
+    if to is None:
+        return
+    fields['metric'] = name
+    fields['time'] = time.time()
+    fields['pid'] = os.getpid()
+    try:
+        with open(to, 'a+') as metricfd:
+            fcntl.lockf(metricfd, fcntl.LOCK_EX)
+            metricfd.write(json.dumps(fields, sort_keys=True) + "\n")
+    except FileNotFoundError:
+        pass
+
 def fail(message):
     log_error(message)
     sys.exit(1)
 
 class ForkingHTTPServer(socketserver.ForkingMixIn, http.server.HTTPServer):
-    pass
+    # Children wait in the TransferScheduler, and the transfers they wait
+    # on need new requests from post-update hooks to finish, so don't
+    # stop accepting at socketserver's default of 40.
+    max_children = DAEMON_MAX_CHILDREN
 
 class TransferRequestHandler(http.server.BaseHTTPRequestHandler):
     def log_message(self, format, *args):
@@ -76,13 +132,24 @@ class TransferRequestHandler(http.server.BaseHTTPRequestHandler):
             params = urllib.parse.parse_qs(content)
             ref = None
             action = params['action'][0]
+            out = ''
             if action == 'ping':
                 pass
+            elif action == 'status':
+                out = json.dumps({'transfers': self.server.scheduler.status(),
+                                  'repos': self.server.registry.status()},
+                                 sort_keys=True) + "\n"
+            elif action == 'scan':
+                out = "%d repos\n" % self.server.registry.scan()
+            elif action == 'remove':
+                self.server.registry.remove(params['repo'][0])
             else:
                 os.chdir(params['repo'][0])
-                sanity_check()
-                ref = params['ref'][0]
-            out = ''
+                if action == 'add':
+                    self.server.registry.check(os.getcwd())
+                else:
+                    self.server.registry.prepare(os.getcwd())
+                    ref = params['ref'][0]
             code = 200
         except SanityCheckFailure as err:
             out = str(err) + "\n"
@@ -104,16 +171,28 @@ class TransferRequestHandler(http.server.BaseHTTPRequestHandler):
         if code == 200 and action and ref:
             try:
                 self.log_message("Transferring %s from %s" % (ref, reporoot()))
-                start_transfer(ref, action)
+                start_transfer(ref, action, self.server.scheduler,
+                               self.server.registry)
             except Exception as err:
                 self.log_error(str(err))
 
-def start_daemon(logpath):
+def start_daemon(logpath, metricspath=None, remotelimit=REMOTE_TRANSFER_LIMIT,
+                 bandwidth=None, registrypath=None, roots=()):
     serveraddr = ('127.0.0.1', DAEMON_PORT)
     try:
         os.setsid()
         daemon = ForkingHTTPServer(serveraddr, TransferRequestHandler)
         log('', to=logpath)
+        metric('daemon_start', to=metricspath)
+        schedpath = os.path.join(tempfile.gettempdir(),
+                                 "piehole-schedule-%d.json" % DAEMON_PORT)
+        daemon.scheduler = TransferScheduler(schedpath, remotelimit,
+                                             bandwidth or {})
+        if registrypath is None:
+            registrypath = os.path.join(os.path.dirname(
+                os.path.abspath(logpath)), "piehole-registry.db")
+        daemon.registry = RepoRegistry(registrypath, roots)
+        log("Serving %d repos" % daemon.registry.scan())
     except OSError as err:
         if 98 == err.errno:
             fail(str(err))
@@ -121,23 +200,130 @@ def start_daemon(logpath):
             raise
     daemon.serve_forever()
 
-def run_git(*args):
-    encoding = locale.getpreferredencoding()
-    lines = []
+@contextlib.contextmanager
+def git_slot(needed, deadline):
+    '''
+    Hold one of GIT_MAX_PROCS lock files, shared by every piehole
+    process on the host, for as long as a network git command runs.
+    '''
+    if not needed:
+        yield
+        return
+    os.makedirs(GIT_SLOT_DIR, exist_ok=True)
+    while True:
+        for i in range(GIT_MAX_PROCS):
+            slotfd = open(os.path.join(GIT_SLOT_DIR, "slot%d" % i), 'a+')
+            try:
+                # flock, unlike lockf, locks this open file rather than
+                # the whole process, so threads don't share a slot.
+                fcntl.flock(slotfd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                slotfd.close()
+                continue
+            try:
+                yield
+            finally:
+                slotfd.close()
+            return
+        if deadline is not None and time.monotonic() >= deadline:
+            raise GitTimeout("Timed out waiting for a git process slot")
+        time.sleep(0.05)
+
+def read_git_output(gitcmd, output, deadline, stream, encoding):
+    '''
+    Collect stdout and stderr from a running git command a line at a
+    time, logging each line as it arrives if stream is set.  Kill the
+    command's process group and return True if the deadline passes.
+
+    Git redraws progress on stderr with carriage returns, so there a
+    line keeps only its last update, and the updates in between are
+    logged no more than once every GIT_PROGRESS_INTERVAL seconds.
+    '''
+    pending = {}
+    progressed = time.monotonic()
+    selector = selectors.DefaultSelector()
+    for name in output:
+        selector.register(getattr(gitcmd, name), selectors.EVENT_READ, name)
+        pending[name] = b''
     try:
-        args = [GIT] + list(args)
-        gitcmd = subprocess.Popen(args,
+        while selector.get_map():
+            wait = None
+            if deadline is not None:
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    os.killpg(gitcmd.pid, signal.SIGKILL)
+                    return True
+            for key, _ in selector.select(wait):
+                name = key.data
+                chunk = os.read(key.fd, 65536)
+                if chunk:
+                    pending[name] += chunk
+                    *lines, pending[name] = pending[name].split(b'\n')
+                    if name == 'stderr':
+                        lines = [line.rstrip(b'\r').rpartition(b'\r')[2]
+                                 for line in lines]
+                        *updates, pending[name] = pending[name].split(b'\r')
+                        now = time.monotonic()
+                        if stream and any(updates) and \
+                           now - progressed >= GIT_PROGRESS_INTERVAL:
+                            progressed = now
+                            update = [u for u in updates if u][-1]
+                            log(update.decode(encoding, errors='replace'))
+                elif pending[name]:
+                    lines, pending[name] = [pending[name]], b''
+                    selector.unregister(key.fileobj)
+                else:
+                    lines = []
+                    selector.unregister(key.fileobj)
+                for line in lines:
+                    text = line.decode(encoding, errors='replace') + '\n'
+                    output[name].append(text)
+                    if stream:
+                        log(text.rstrip('\n'))
+        return False
+    finally:
+        selector.close()
+
+def run_git(*args, timeout=GIT_TIMEOUT, stream=False):
+    '''
+    Run git and return its standard output.  Raise GitFailure, with
+    stdout and stderr kept separately, if git fails, and GitTimeout
+    if it runs longer than timeout seconds.  With stream set, log
+    output as it arrives and keep only the last GIT_TAIL_LINES lines.
+    '''
+    encoding = locale.getpreferredencoding()
+    keep = GIT_TAIL_LINES if stream else None
+    output = collections.OrderedDict((name, collections.deque(maxlen=keep))
+                                     for name in ('stdout', 'stderr'))
+    start = time.monotonic()
+    deadline = None if timeout is None else start + timeout
+    with git_slot(args[0] in GIT_NETWORK_COMMANDS, deadline):
+        queued = time.monotonic() - start
+        gitcmd = subprocess.Popen([GIT] + list(args),
+                                  stdin=subprocess.DEVNULL,
                                   stdout=subprocess.PIPE,
-                                  stderr=subprocess.STDOUT)
-        for line in gitcmd.stdout:
-            lines.append(line.decode(encoding))
-        gitcmd.stdout.close()
-        code = gitcmd.wait()
-        if code != 0:
-            raise GitFailure(''.join(lines))
-        return ''.join(lines)
-    except subprocess.CalledProcessError:
-        raise GitFailure(''.join(lines)) 
+                                  stderr=subprocess.PIPE,
+                                  start_new_session=True)
+        try:
+            timed_out = read_git_output(gitcmd, output, deadline,
+                                        stream, encoding)
+        finally:
+            gitcmd.stdout.close()
+            gitcmd.stderr.close()
+            _, status, usage = os.wait4(gitcmd.pid, 0)
+            gitcmd.returncode = os.waitstatus_to_exitcode(status)
+    metric('git', command=args[0], returncode=gitcmd.returncode,
+           wall=time.monotonic() - start, queued=queued,
+           user=usage.ru_utime, sys=usage.ru_stime, timed_out=timed_out)
+    stdout = ''.join(output['stdout'])
+    stderr = ''.join(output['stderr'])
+    if timed_out:
+        raise GitTimeout("git %s timed out after %s seconds\n%s" %
+                         (args[0], timeout, stderr),
+                         gitcmd.returncode, stdout, stderr)
+    if gitcmd.returncode != 0:
+        raise GitFailure(stdout + stderr, gitcmd.returncode, stdout, stderr)
+    return stdout
 
 def list_refs():
     result = []
@@ -163,6 +349,14 @@ def reporef(ref):
     except GitFailure:
         return BLANK
 
+def previous(ref):
+    "The value ref had before its last update, from the reflog."
+    try:
+        return run_git('rev-parse', '--quiet', '--verify',
+                       "%s@{1}" % ref).strip()
+    except GitFailure:
+        return BLANK
+
 def guess_repourl():
     return urllib.parse.urljoin("file:///",
             urllib.request.pathname2url(reporoot()))
@@ -174,8 +368,11 @@ def guess_reponame():
     else:
         return name
 
-def config(key, value=None, cache={}):
-    git_key = key if '.' in key else '.'.join((CONFIG_PREFIX, key))
+def config_key(key):
+    return key if '.' in key else '.'.join((CONFIG_PREFIX, key))
+
+def config(key, value=None, cache=CONFIG_CACHE):
+    git_key = config_key(key)
     if value is None:
         if key in cache:
             return cache[key]
@@ -190,39 +387,248 @@ def config(key, value=None, cache={}):
         cache[key] = value
         return value
 
-def etcd_loc(key):
-    return "%s/v1/keys/%s/%s" % (config('etcdroot'), config('etcdprefix'),
-                                urllib.parse.quote(key))
-
-def etcd_read(key):
-    loc = etcd_loc(key)
+def config_snapshot():
+    "The settings named in CONFIG_KEYS, read with one git command."
     try:
-        res = urllib.request.urlopen(loc).read().decode('ascii').strip()
-        data = json.loads(res)
-        return data['value']
-    except urllib.error.HTTPError as err:
-        if err.code >= 400 and err.code < 500:
-            return None
-        else:
+        res = run_git('config', '--local', '--get-regexp',
+                      r'^(core|%s)\.' % CONFIG_PREFIX)
+    except GitFailure as err:
+        if err.returncode != 1: # 1: nothing matched
             raise
+        res = ''
+    found = dict(line.partition(' ')[::2] for line in res.splitlines())
+    return dict((key, found.get(config_key(key).lower()))
+                for key in CONFIG_KEYS)
 
-def etcd_write(key, value, prev=None):
-    loc = etcd_loc(key)
-    params = {'value': value}
-    if prev is not None:
-        params['prevValue'] = prev
-    postdata = urllib.parse.urlencode(params).encode('ascii')
-    try:
-        res = urllib.request.urlopen(loc, postdata)
-        charset = res.headers.get_param('charset')
-        data = json.loads(res.read().decode(charset))
-        return True if data.get('action') == 'SET' else False
-    except urllib.error.HTTPError as err:
-        charset = err.headers.get_param('charset')
-        data = json.loads(err.read().decode(charset))
-        log(data.get('message'))
-        log(data.get('cause'))
-        return False
+class ConsensusBackend:
+    '''
+    Where a repogroup keeps its membership and consensus refs.
+
+    A prev of None writes unconditionally, '' writes only if the key
+    does not exist yet, and anything else writes only if the key
+    currently has that value.  Reads of missing keys return None.
+    '''
+    def __init__(self, root, prefix):
+        self.root = root
+        self.prefix = prefix
+
+    def read(self, key):
+        raise NotImplementedError
+
+    def write(self, key, value, prev=None):
+        raise NotImplementedError
+
+    def read_many(self, keys):
+        return dict((key, self.read(key)) for key in keys)
+
+    def write_many(self, items):
+        "Write (key, value, prev) items.  Not atomic unless overridden."
+        return all([self.write(*item) for item in items])
+
+    def range(self, prefix):
+        "All keys starting with prefix, and their values."
+        raise NotImplementedError
+
+class EtcdV1Backend(ConsensusBackend):
+    "The etcd v1 keys API, as used by the first piehole releases."
+    def loc(self, key):
+        return "%s/v1/keys/%s/%s" % (self.root, self.prefix,
+                                     urllib.parse.quote(key))
+
+    def read(self, key):
+        try:
+            res = urllib.request.urlopen(self.loc(key)).read()
+            data = json.loads(res.decode('ascii').strip())
+            return data['value']
+        except urllib.error.HTTPError as err:
+            if err.code >= 400 and err.code < 500:
+                return None
+            else:
+                raise
+
+    def write(self, key, value, prev=None):
+        params = {'value': value}
+        if prev is not None:
+            params['prevValue'] = prev
+        postdata = urllib.parse.urlencode(params).encode('ascii')
+        try:
+            res = urllib.request.urlopen(self.loc(key), postdata)
+            charset = res.headers.get_param('charset')
+            data = json.loads(res.read().decode(charset))
+            return True if data.get('action') == 'SET' else False
+        except urllib.error.HTTPError as err:
+            charset = err.headers.get_param('charset')
+            data = json.loads(err.read().decode(charset))
+            log(data.get('message'))
+            log(data.get('cause'))
+            return False
+
+    def range(self, prefix):
+        "Walk the directories that a / in a key makes in etcd."
+        start = "/%s/" % self.prefix
+        result = {}
+        pending = ['']
+        while pending:
+            try:
+                res = urllib.request.urlopen(self.loc(pending.pop())).read()
+            except urllib.error.HTTPError as err:
+                if err.code >= 400 and err.code < 500:
+                    continue
+                raise
+            nodes = json.loads(res.decode('utf-8'))
+            for node in nodes if isinstance(nodes, list) else [nodes]:
+                key = node['key'][len(start):]
+                if node.get('dir'):
+                    if (key + '/').startswith(prefix) or \
+                       prefix.startswith(key + '/'):
+                        pending.append(key + '/')
+                elif key.startswith(prefix):
+                    result[key] = node['value']
+        return result
+
+class EtcdV3Backend(ConsensusBackend):
+    '''
+    The etcd v3 API through its JSON gateway.  Compare-and-swap of
+    several keys happens in one transaction, and batched and range
+    reads take one round trip, as long as they fit in ETCD_V3_TXN_OPS
+    operations; etcd refuses bigger transactions.
+    '''
+    @staticmethod
+    def encode(text):
+        return base64.b64encode(text.encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def decode(data):
+        return base64.b64decode(data).decode('utf-8')
+
+    def key(self, key):
+        return self.encode("%s/%s" % (self.prefix, key))
+
+    def call(self, method, params, timeout=None):
+        loc = "%s/v3/%s" % (self.root, method)
+        postdata = json.dumps(params).encode('utf-8')
+        res = urllib.request.urlopen(loc, postdata, timeout=timeout)
+        return json.loads(res.read().decode('utf-8'))
+
+    def compare(self, key, prev):
+        if prev == '':
+            return {'key': self.key(key), 'target': 'CREATE',
+                    'result': 'EQUAL', 'create_revision': 0}
+        return {'key': self.key(key), 'target': 'VALUE',
+                'result': 'EQUAL', 'value': self.encode(prev)}
+
+    def read(self, key):
+        return self.read_many([key])[key]
+
+    def read_many(self, keys):
+        keys = list(keys)
+        result = {}
+        for start in range(0, len(keys), ETCD_V3_TXN_OPS):
+            batch = keys[start:start + ETCD_V3_TXN_OPS]
+            data = self.call('kv/txn', {'success': [
+                {'request_range': {'key': self.key(key)}} for key in batch]})
+            for key, response in zip(batch, data.get('responses', [])):
+                kvs = response['response_range'].get('kvs', [])
+                result[key] = self.decode(kvs[0]['value']) if kvs else None
+        return result
+
+    def write(self, key, value, prev=None):
+        return self.write_many([(key, value, prev)])
+
+    def write_many(self, items):
+        '''
+        Write up to ETCD_V3_TXN_OPS items in one transaction.  More
+        than that are written a transaction at a time, so each batch
+        is atomic but the whole is not: if a batch fails its compare,
+        the batches before it stay written and the rest are not tried.
+        '''
+        items = list(items)
+        for start in range(0, len(items), ETCD_V3_TXN_OPS):
+            txn = {'compare': [], 'success': []}
+            for key, value, prev in items[start:start + ETCD_V3_TXN_OPS]:
+                if prev is not None:
+                    txn['compare'].append(self.compare(key, prev))
+                txn['success'].append({'request_put': {
+                    'key': self.key(key), 'value': self.encode(value)}})
+            if not self.call('kv/txn', txn).get('succeeded'):
+                if start:
+                    log_error("Wrote only the first %d of %d keys" %
+                              (start, len(items)))
+                return False
+        return True
+
+    def range(self, prefix):
+        start = "%s/%s" % (self.prefix, prefix)
+        end = start[:-1] + chr(ord(start[-1]) + 1)
+        data = self.call('kv/range', {'key': self.encode(start),
+                                      'range_end': self.encode(end)})
+        skip = len(self.prefix) + 1
+        return dict((self.decode(kv['key'])[skip:], self.decode(kv['value']))
+                    for kv in data.get('kvs', []))
+
+class LocalBackend(ConsensusBackend):
+    '''
+    Keys in a SQLite database file, for repogroups whose members are
+    all on one host, and for benchmarks.  The root is the file path.
+    '''
+    def __init__(self, root, prefix):
+        super(LocalBackend, self).__init__(root, prefix)
+        self.db = sqlite3.connect(root, timeout=60, isolation_level=None)
+        self.db.execute("CREATE TABLE IF NOT EXISTS consensus "
+                        "(key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def key(self, key):
+        return "%s/%s" % (self.prefix, key)
+
+    def read(self, key):
+        row = self.db.execute("SELECT value FROM consensus WHERE key = ?",
+                              (self.key(key),)).fetchone()
+        return row[0] if row else None
+
+    def write(self, key, value, prev=None):
+        return self.write_many([(key, value, prev)])
+
+    def write_many(self, items):
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            for key, value, prev in items:
+                if prev is not None and (self.read(key) or '') != prev:
+                    self.db.execute("ROLLBACK")
+                    return False
+                self.db.execute("INSERT OR REPLACE INTO consensus "
+                                "VALUES (?, ?)", (self.key(key), value))
+            self.db.execute("COMMIT")
+            return True
+        except:
+            self.db.execute("ROLLBACK")
+            raise
+
+    def range(self, prefix):
+        start = self.key(prefix)
+        rows = self.db.execute("SELECT key, value FROM consensus "
+                               "WHERE substr(key, 1, ?) = ?",
+                               (len(start), start))
+        skip = len(self.prefix) + 1
+        return dict((key[skip:], value) for key, value in rows)
+
+CONSENSUS_BACKENDS = {
+    'etcd': EtcdV1Backend,
+    'etcd3': EtcdV3Backend,
+    'local': LocalBackend,
+}
+
+def consensus(cache={}):
+    "The consensus backend configured for this repo."
+    kind = config('consensus') or CONSENSUS
+    where = (kind, config('etcdroot'), config('etcdprefix'))
+    if where not in cache:
+        try:
+            backend = CONSENSUS_BACKENDS[kind]
+        except KeyError:
+            raise SanityCheckFailure("Unknown %s.consensus %s" %
+                                     (CONFIG_PREFIX, kind))
+        cache[where] = backend(*where[1:])
+    return cache[where]
 
 def invoke_daemon(repo, ref, action):
     params = {'repo': repo, 'ref': ref, 'action': action}
@@ -247,6 +653,9 @@ def sanity_check(installed=True):
     for item in ('etcdprefix', 'etcdroot', 'repourl', 'repogroup'):
         if installed and not config(item):
             raise SanityCheckFailure("%s.%s not set" % (CONFIG_PREFIX, item))
+    if installed and config('state') == 'seeding':
+        raise SanityCheckFailure("%s is still being seeded from %s" %
+                                 (os.getcwd(), config('repogroup')))
     for hook in ('update', 'post-update'):
         path = os.path.join(reporoot(), 'hooks', hook)
         if os.path.isfile(path) and os.path.isfile(__file__):
@@ -256,7 +665,7 @@ def sanity_check(installed=True):
                 raise SanityCheckFailure("%s is not executable" % path)
 
 def repogroup_members():
-    members = etcd_read(config('repogroup'))
+    members = consensus().read(config('repogroup'))
     if members is None:
         present = []
     else:
@@ -265,6 +674,8 @@ def repogroup_members():
     return present
 
 def add_to_repogroup():
+    if config('state') == 'seeding':
+        return
     while True:
         present = repogroup_members()
         if config('repourl') in present:
@@ -273,7 +684,8 @@ def add_to_repogroup():
         present.append(config('repourl'))
         present.sort()
         newmembers = ' '.join(present)
-        newvalue = etcd_write(config('repogroup'), newmembers, oldmembers)
+        newvalue = consensus().write(config('repogroup'), newmembers,
+                                     oldmembers)
         if newvalue:
             break
 
@@ -285,16 +697,100 @@ def register(fn):
         fn(*args)
     return wrapped
 
-def install(repogroup, repourl, etcdroot, etcdprefix):
+def pack_size():
+    "Bytes of objects stored in this repo, packed and loose."
+    counts = dict(line.split(': ', 1) for line in
+                  run_git('count-objects', '-v').splitlines())
+    return 1024 * (int(counts['size']) + int(counts['size-pack']))
+
+def remote_refs(remote):
+    "The branches and tags a remote has, from one ls-remote."
+    res = run_git('ls-remote', '--refs', '--heads', '--tags', remote)
+    return dict(reversed(line.split('\t', 1)) for line in res.splitlines())
+
+def best_member(members):
+    '''
+    Find the member that agrees with etcd about the most refs.
+    Return it, or None if no member answers, along with the
+    consensus value of every ref any member has, read from etcd
+    in one range request.
+    '''
+    advertised = {}
+    for remote in members:
+        try:
+            advertised[remote] = remote_refs(remote)
+        except GitFailure as err:
+            log_error("Not seeding from %s: %s" % (remote, err))
+    refs = set()
+    for advertised_refs in advertised.values():
+        refs.update(advertised_refs)
+    group = "%s " % config('repogroup')
+    values = consensus().range(group + 'refs/')
+    agreed = dict((ref, values.get(group + ref)) for ref in refs)
+    def agreement(remote):
+        refs = advertised[remote]
+        return len([r for r in refs if refs[r] == agreed[r]])
+    best = max(advertised, key=agreement, default=None)
+    return best, agreed
+
+def seed(bundle=None):
+    '''
+    Fetch everything the repogroup has into this repo before it
+    becomes an active member, then check the refs against etcd.
+    Start from a bundle file if there is one, so that only recent
+    objects have to come from another member.
+    '''
+    start = time.monotonic()
+    before = pack_size()
+    if bundle:
+        log("Seeding from bundle %s" % bundle)
+        run_git('fetch', '--progress', bundle, *SEED_REFSPECS,
+                timeout=SEED_TIMEOUT, stream=True)
+    here = config('repourl')
+    members = [m for m in repogroup_members() if m != here]
+    source, agreed = best_member(members)
+    if source:
+        log("Seeding %d refs from %s" % (len(agreed), source))
+        run_git('fetch', '--progress', source, *SEED_REFSPECS,
+                timeout=SEED_TIMEOUT, stream=True)
+    mismatched = []
+    for ref, want in sorted(agreed.items()):
+        if want is None or reporef(ref) == want:
+            continue
+        try:
+            run_git('update-ref', ref, want)
+        except GitFailure:
+            mismatched.append(ref)
+    for ref in mismatched:
+        log_error("%s does not match etcd; it will catch up on update" % ref)
+    seconds = time.monotonic() - start
+    size = pack_size() - before
+    log("Seeded %d bytes in %.1fs (%.0f bytes/s)" %
+        (size, seconds, size / seconds if seconds else 0))
+    metric('seed', source=source, refs=len(agreed), bytes=size,
+           seconds=seconds, mismatched=len(mismatched))
+
+def install(repogroup, repourl, etcdroot, etcdprefix, seeded=True,
+            bundle=None, backend=CONSENSUS):
     try:
         sanity_check(installed=False)
     except SanityCheckFailure as err:
         fail(str(err))
+    if backend == 'local':
+        if '://' in etcdroot:
+            fail("--consensus=local needs --etcdroot set to a database "
+                 "file, not %s" % etcdroot)
+        etcdroot = os.path.abspath(etcdroot)
+        try:
+            LocalBackend(etcdroot, etcdprefix)
+        except sqlite3.Error as err:
+            fail("Can't use %s as a consensus database: %s" % (etcdroot, err))
     for hook in ('update', 'post-update'):
         path = os.path.join(reporoot(), 'hooks', hook)
         shutil.copyfile(__file__, path)
         os.chmod(path, 0o755)
     config('core.logAllRefUpdates', 'true')
+    config('consensus', backend)
     config('etcdroot', etcdroot)
     config('etcdprefix', etcdprefix)
     config('repogroup', repogroup)
@@ -302,13 +798,431 @@ def install(repogroup, repourl, etcdroot, etcdprefix):
     if repourl.startswith('file'):
         log("Using %s for repo URL." % repourl)
         log("You probably want an ssh URL instead.")
+    if seeded and config('state') != 'active':
+        config('state', 'seeding')
+        try:
+            seed(bundle)
+        except GitFailure as err:
+            fail("Seeding failed, run install again to retry:\n%s" % err)
+    config('state', 'active')
     add_to_repogroup()
+    try:
+        invoke_daemon(reporoot(), '', 'add')
+    except urllib.error.URLError:
+        log("The piehole daemon is not running.  It will add this repo")
+        log("when it starts, if the repo is under one of its --root dirs.")
 
-@register
-def start_transfer(ref, command):
+def peer_host(url):
+    '''
+    The host part of a remote URL, used to group transfers by link.
+    A repo on this host is a peer of its own.
+    '''
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme == 'file':
+        return parts.path
+    if parts.scheme:
+        return parts.hostname or 'localhost'
+    if ':' in url.split('/')[0]:
+        return url.split(':')[0].split('@')[-1] # scp-like user@host:path
+    return url
+
+def transfer_class(ref, command):
+    if command == 'fetch':
+        return 'fetch'
+    if ref.startswith('refs/heads/'):
+        return 'branch'
+    return 'bulk'
+
+def transfer_size(new, old=BLANK):
+    "Bytes of objects reachable from new but not from old."
+    args = ['rev-list', '--objects', '--disk-usage', new]
+    if old != BLANK:
+        args += ['--not', old]
+    try:
+        return int(run_git(*args).strip() or 0)
+    except (GitFailure, ValueError):
+        return 0
+
+class TransferScheduler:
+    '''
+    Decide which waiting transfer runs next, across all the daemon's
+    children.  Transfers are admitted in TRANSFER_CLASSES order,
+    oldest first, with a waiting transfer moving up one class every
+    SCHEDULER_AGING seconds so that bulk work still gets done.  No
+    peer host gets more than remotelimit transfers at once, and a
+    peer with a bandwidth cap (bytes per second) gets no new
+    transfers until the bytes already sent have been paid for.
+
+    A waiting transfer sleeps on its own FIFO next to the state file,
+    and is woken when another transfer starts or finishes.  It also
+    looks again when a peer's bandwidth has been paid for, and every
+    SCHEDULER_RECHECK seconds in case a transfer died without saying.
+    '''
+    def __init__(self, path, remotelimit=REMOTE_TRANSFER_LIMIT,
+                 bandwidth=None, totallimit=GIT_MAX_PROCS):
+        self.path = path
+        self.remotelimit = remotelimit
+        self.bandwidth = bandwidth or {}
+        self.totallimit = totallimit
+        with open(path, 'w') as statefd:
+            json.dump({'waiting': [], 'running': [], 'paid_until': {}},
+                      statefd)
+
+    @contextlib.contextmanager
+    def state(self):
+        with open(self.path, 'r+') as statefd:
+            fcntl.flock(statefd, fcntl.LOCK_EX)
+            text = statefd.read()
+            state = json.loads(text)
+            for queue in ('waiting', 'running'):
+                for ticket in state[queue]:
+                    if not alive(ticket['pid']) and ticket.get('wake'):
+                        remove_quietly(ticket['wake'])
+                state[queue] = [t for t in state[queue] if alive(t['pid'])]
+            yield state
+            changed = json.dumps(state)
+            if changed != text:
+                statefd.seek(0)
+                statefd.truncate()
+                statefd.write(changed)
+
+    @staticmethod
+    def wake(state):
+        "Tell every waiting transfer to look at the queue again."
+        for ticket in state['waiting']:
+            try:
+                fd = os.open(ticket['wake'], os.O_WRONLY | os.O_NONBLOCK)
+            except (KeyError, OSError):
+                continue
+            try:
+                os.write(fd, b'.')
+            except OSError:
+                pass
+            finally:
+                os.close(fd)
+
+    def sleep(self, wakefd, state, now):
+        "Wait for a wake-up, or until something changes on its own."
+        paid = [t - now for t in state['paid_until'].values() if t > now]
+        timeout = min(paid + [SCHEDULER_RECHECK])
+        with selectors.DefaultSelector() as selector:
+            selector.register(wakefd, selectors.EVENT_READ)
+            if selector.select(timeout):
+                try:
+                    while os.read(wakefd, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+
+    def capped(self, remote):
+        return peer_host(remote) in self.bandwidth
+
+    def rank(self, ticket, now):
+        age = now - ticket['queued']
+        return (TRANSFER_CLASSES.index(ticket['class']) -
+                age / SCHEDULER_AGING, ticket['queued'])
+
+    def admit(self, state, ticket, now):
+        running = state['running']
+        if len(running) >= self.totallimit:
+            return False
+        busy = collections.Counter(t['peer'] for t in running)
+        for waiting in sorted(state['waiting'],
+                              key=lambda t: self.rank(t, now)):
+            peer = waiting['peer']
+            if busy[peer] >= self.remotelimit:
+                continue
+            if state['paid_until'].get(peer, 0) > now:
+                continue
+            if waiting['id'] != ticket['id']:
+                return False
+            state['waiting'].remove(waiting)
+            running.append(waiting)
+            return True
+        return False
+
+    @contextlib.contextmanager
+    def transfer(self, klass, remote, what=None):
+        '''
+        Wait for a turn to transfer to or from remote.  The caller
+        may set 'bytes' in the yielded ticket to charge the transfer
+        against the peer's bandwidth cap.  If the same transfer, as
+        named by what, is already waiting, yield None instead: that
+        one will send whatever the ref points to when it starts.
+        '''
+        ticket = {'id': uuid.uuid4().hex, 'pid': os.getpid(),
+                  'class': klass, 'peer': peer_host(remote),
+                  'remote': remote, 'what': what, 'queued': time.time()}
+        ticket['wake'] = "%s.%s" % (self.path, ticket['id'])
+        os.mkfifo(ticket['wake'])
+        # Holding a write end too keeps the FIFO from reading as
+        # closed, and so from waking the selector, between wake-ups.
+        wakefd = os.open(ticket['wake'], os.O_RDONLY | os.O_NONBLOCK)
+        keepfd = os.open(ticket['wake'], os.O_WRONLY)
+        try:
+            with self.state() as state:
+                queued = what is not None and [t for t in state['waiting']
+                                               if t['what'] == what and
+                                                  t['remote'] == remote]
+                if not queued:
+                    state['waiting'].append(ticket)
+            if queued:
+                log("%s to %s is already queued" % (what, remote))
+                metric('transfer_coalesced', cls=klass, peer=ticket['peer'])
+                yield None
+                return
+            while True:
+                with self.state() as state:
+                    now = time.time()
+                    if self.admit(state, ticket, now):
+                        self.wake(state)
+                        break
+                self.sleep(wakefd, state, now)
+        finally:
+            os.close(wakefd)
+            os.close(keepfd)
+            remove_quietly(ticket['wake'])
+        wait = time.time() - ticket['queued']
+        log("Waited %.3fs to start %s transfer with %s" %
+            (wait, klass, remote))
+        metric('transfer_wait', cls=klass, peer=ticket['peer'], wait=wait)
+        try:
+            yield ticket
+        finally:
+            with self.state() as state:
+                state['running'] = [t for t in state['running']
+                                    if t['id'] != ticket['id']]
+                cap = self.bandwidth.get(ticket['peer'])
+                if cap and ticket.get('bytes'):
+                    paid = max(state['paid_until'].get(ticket['peer'], 0),
+                               time.time())
+                    state['paid_until'][ticket['peer']] = (
+                        paid + ticket['bytes'] / cap)
+                self.wake(state)
+
+    def status(self):
+        "Queue lengths and the longest wait so far, by transfer class."
+        now = time.time()
+        with self.state() as state:
+            result = {}
+            for klass in TRANSFER_CLASSES:
+                waits = [now - t['queued'] for t in state['waiting']
+                         if t['class'] == klass]
+                result[klass] = {
+                    'waiting': len(waits),
+                    'running': len([t for t in state['running']
+                                    if t['class'] == klass]),
+                    'longest_wait': max(waits, default=0),
+                }
+            return result
+
+class RepoRegistry:
+    '''
+    The bare repos this daemon serves, kept in an SQLite file so that
+    every daemon child shares it and the daemon's own memory does not
+    grow with the number of repos.  Each repo has a row with its
+    piehole settings, group, last known membership and health.  A repo
+    that passed its sanity check less than REGISTRY_TTL seconds ago
+    is not checked again, and its settings come from the row instead
+    of from git, unless the repo's config file has changed since.
+    '''
+    def __init__(self, path, roots=()):
+        self.path = path
+        self.roots = roots
+        self.connections = {}
+        self.db().execute("CREATE TABLE IF NOT EXISTS repos ("
+                          "path TEXT PRIMARY KEY, config TEXT, "
+                          "repogroup TEXT, members TEXT, "
+                          "health TEXT NOT NULL, checked REAL NOT NULL, "
+                          "stamp INTEGER, "
+                          "transfers INTEGER NOT NULL DEFAULT 0, "
+                          "failures INTEGER NOT NULL DEFAULT 0, "
+                          "last_error TEXT)")
+        self.db().execute("CREATE TABLE IF NOT EXISTS peers ("
+                          "repogroup TEXT, remote TEXT, refreshed REAL, "
+                          "PRIMARY KEY (repogroup, remote))")
+        self.db().execute("CREATE TABLE IF NOT EXISTS peer_refs ("
+                          "repogroup TEXT, remote TEXT, ref TEXT, "
+                          "commit_id TEXT, confirmed REAL, "
+                          "PRIMARY KEY (repogroup, remote, ref))")
+
+    def db(self):
+        "One connection per process, since children fork from the daemon."
+        pid = os.getpid()
+        if pid not in self.connections:
+            self.connections = {pid: sqlite3.connect(
+                self.path, timeout=60, isolation_level=None)}
+        return self.connections[pid]
+
+    def scan(self):
+        '''
+        Add every piehole repo under the configured roots, unchecked,
+        forget repos that no longer exist, and return how many repos
+        are registered.
+        '''
+        for (path,) in self.db().execute("SELECT path FROM repos").fetchall():
+            if not os.path.isdir(path):
+                log("Forgetting %s, which is gone" % path)
+                self.remove(path)
+        for root in self.roots:
+            for dirpath, dirnames, filenames in os.walk(root):
+                if 'HEAD' in filenames and 'objects' in dirnames and \
+                   os.path.isfile(os.path.join(dirpath, 'hooks', 'post-update')):
+                    self.db().execute("INSERT OR IGNORE INTO repos "
+                                      "(path, health, checked) "
+                                      "VALUES (?, 'unchecked', 0)",
+                                      (os.path.realpath(dirpath),))
+                    dirnames[:] = []
+        return self.db().execute("SELECT count(*) FROM repos").fetchone()[0]
+
+    def remove(self, path):
+        self.db().execute("DELETE FROM repos WHERE path = ?",
+                          (os.path.realpath(path),))
+
+    def lookup(self, path):
+        row = self.db().execute("SELECT config, members, health, checked, "
+                                "stamp FROM repos WHERE path = ?",
+                                (path,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return {'config': json.loads(row[0]), 'members': json.loads(row[1]),
+                'health': row[2], 'checked': row[3], 'stamp': row[4]}
+
+    @staticmethod
+    def stamp(path):
+        try:
+            return os.stat(os.path.join(path, 'config')).st_mtime_ns
+        except OSError:
+            return None
+
+    def check(self, path):
+        '''
+        Sanity check the repo in the current directory, enroll it in
+        its group, and record the result for the repo at path.
+        '''
+        path = os.path.realpath(path)
+        stamp = self.stamp(path)
+        try:
+            try:
+                snapshot = config_snapshot()
+            except GitFailure:
+                raise SanityCheckFailure("%s does not seem to be a Git "
+                                         "repository" % path)
+            CONFIG_CACHE.update(snapshot)
+            sanity_check()
+        except SanityCheckFailure as err:
+            self.db().execute("INSERT INTO repos (path, health, checked) "
+                              "VALUES (?, ?, ?) ON CONFLICT (path) DO UPDATE "
+                              "SET health = excluded.health, "
+                              "checked = excluded.checked",
+                              (path, str(err), time.time()))
+            raise
+        add_to_repogroup()
+        self.db().execute("INSERT INTO repos "
+                          "(path, config, repogroup, members, health, checked, "
+                          "stamp) VALUES (?, ?, ?, ?, 'ok', ?, ?) "
+                          "ON CONFLICT (path) DO UPDATE "
+                          "SET config = excluded.config, "
+                          "repogroup = excluded.repogroup, "
+                          "members = excluded.members, health = 'ok', "
+                          "checked = excluded.checked, stamp = excluded.stamp",
+                          (path, json.dumps(snapshot), snapshot['repogroup'],
+                           json.dumps(repogroup_members()), time.time(), stamp))
+
+    def prepare(self, path):
+        "Get ready to transfer from the repo in the current directory."
+        path = os.path.realpath(path)
+        entry = self.lookup(path)
+        if entry is None or entry['health'] != 'ok' or \
+           time.time() - entry['checked'] > REGISTRY_TTL or \
+           entry['stamp'] != self.stamp(path):
+            return self.check(path)
+        CONFIG_CACHE.update(entry['config'])
+        if config('repourl') not in entry['members']:
+            add_to_repogroup()
+
+    def record_transfer(self, path, members, errors):
+        self.db().execute("UPDATE repos SET members = ?, "
+                          "transfers = transfers + 1, failures = ?, "
+                          "last_error = ? WHERE path = ?",
+                          (json.dumps(members), len(errors),
+                           errors[-1] if errors else None,
+                           os.path.realpath(path)))
+
+    def confirm(self, remote, refs):
+        "Record that remote has just been seen with these ref values."
+        now = time.time()
+        self.db().executemany("INSERT OR REPLACE INTO peer_refs "
+                              "VALUES (?, ?, ?, ?, ?)",
+                              [(config('repogroup'), remote, ref, commit, now)
+                               for ref, commit in refs.items()])
+
+    def peer_stale(self, remote):
+        "Whether remote's refs were last read over PEER_REF_TTL seconds ago."
+        row = self.db().execute("SELECT refreshed FROM peers "
+                                "WHERE repogroup = ? AND remote = ?",
+                                (config('repogroup'), remote)).fetchone()
+        return row is None or time.time() - row[0] >= PEER_REF_TTL
+
+    def refresh_peer(self, remote):
+        '''
+        Read all of remote's refs with one ls-remote, if that has
+        not been done for this group in the last PEER_REF_TTL seconds.
+        '''
+        if not self.peer_stale(remote):
+            return
+        self.db().execute("INSERT OR REPLACE INTO peers VALUES (?, ?, ?)",
+                          (config('repogroup'), remote, time.time()))
+        try:
+            self.confirm(remote, remote_refs(remote))
+        except GitFailure as err:
+            log_error(str(err))
+
+    def peer_has(self, remote, ref, commit):
+        "Whether remote was seen with ref at commit in the last PEER_REF_TTL."
+        row = self.db().execute("SELECT commit_id FROM peer_refs "
+                                "WHERE repogroup = ? AND remote = ? "
+                                "AND ref = ? AND confirmed > ?",
+                                (config('repogroup'), remote, ref,
+                                 time.time() - PEER_REF_TTL)).fetchone()
+        return row is not None and row[0] == commit
+
+    def status(self):
+        "Counts of repos by health, and a few of the unhealthy ones."
+        db = self.db()
+        counts = dict(db.execute("SELECT health = 'ok', count(*) FROM repos "
+                                 "GROUP BY health = 'ok'").fetchall())
+        unhealthy = db.execute("SELECT path, CASE WHEN health != 'ok' "
+                               "THEN health ELSE last_error END "
+                               "FROM repos WHERE health != 'ok' "
+                               "OR failures > 0 LIMIT 20").fetchall()
+        return {'healthy': counts.get(1, 0), 'other': counts.get(0, 0),
+                'problems': dict(unhealthy)}
+
+@contextlib.contextmanager
+def unscheduled(klass, remote, what=None):
+    yield {}
+
+def remove_quietly(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+def start_transfer(ref, command, scheduler=None, registry=None):
     '''
     Start transferring objects to or from the repos
-    in the repogroup.
+    in the repogroup.  The daemon checks the repo and
+    enrolls it in its group first, through the registry.
     '''
     if command not in ['fetch', 'push']:
         raise NotImplementedError("Unknown command: %s" % command)
@@ -320,13 +1234,49 @@ def start_transfer(ref, command):
     else:
         raise NotImplementedError("%s of unknown item %s" % (command, ref))
     target = "%s:%s" % (refname, refname) if command == 'fetch' else refname
-    for remote in repogroup_members(): 
+    klass = transfer_class(ref, command)
+    what = "%s %s %s" % (command, reporoot(), ref)
+    schedule = scheduler.transfer if scheduler else unscheduled
+    members = repogroup_members()
+    errors = []
+    for remote in members:
         if remote == here:
             continue
         try:
-            log(run_git(command, remote, target))
+            with schedule(klass, remote, what) as ticket:
+                if ticket is None:
+                    continue
+                before = reporef(ref)
+                # Decide only once admitted: a queued push may wait long
+                # enough for the peer to get the ref from another member.
+                if command == 'push' and registry:
+                    registry.refresh_peer(remote)
+                    if registry.peer_has(remote, ref, before):
+                        log("%s already has %s" % (remote, ref))
+                        metric('push_skipped', peer=peer_host(remote))
+                        continue
+                args = [command, '--porcelain'] if command == 'push' else [command]
+                res = run_git(*(args + [remote, target]),
+                              timeout=GIT_TRANSFER_TIMEOUT, stream=True)
+                noop = command == 'push' and "\t[up to date]" in res
+                if noop:
+                    metric('push_noop', peer=peer_host(remote))
+                if registry:
+                    sent = before if command == 'push' else reporef(ref)
+                    registry.confirm(remote, {ref: sent})
+                # A push that sent nothing costs the peer's link nothing.
+                if scheduler and scheduler.capped(remote) and not noop:
+                    if command == 'push':
+                        ticket['bytes'] = transfer_size(before,
+                                                        previous(ref))
+                    else:
+                        ticket['bytes'] = transfer_size(reporef(ref),
+                                                        before)
         except GitFailure as f:
             log_error(str(f))
+            errors.append(str(f).strip()[-500:])
+    if registry:
+        registry.record_transfer(os.getcwd(), members, errors)
 
 @register
 def post_update():
@@ -346,13 +1296,13 @@ def update():
     '''
     ref, old, new = sys.argv[1:4]
     repogroup = config('repogroup')
-    current = etcd_read("%s %s" % (repogroup, ref))
+    current = consensus().read("%s %s" % (repogroup, ref))
     if current == new: 
         # This is safe even if the ref just changed since reading from etcd.
         log("Accepting replication of %s from %s to %s" % (ref, old, new))
         sys.exit(0)
     oldval = '' if old == BLANK else old
-    if etcd_write("%s %s" % (repogroup, ref), new, oldval):
+    if consensus().write("%s %s" % (repogroup, ref), new, oldval):
         log("Updating %s from %s to %s." % (ref, old, new))
         sys.exit(0)
     try:
@@ -366,8 +1316,10 @@ def update():
     sys.exit(1)
 
 def clobber():
-    for ref in list_refs():
-        etcd_write("%s %s" % (config('repogroup'), ref), reporef(ref))
+    if not consensus().write_many([("%s %s" % (config('repogroup'), ref),
+                                    reporef(ref), None)
+                                   for ref in list_refs()]):
+        fail("Failed to write this repo's refs to %s" % config('etcdroot'))
     sys.exit(0)
 
 if __name__ == '__main__':
@@ -393,21 +1345,49 @@ if __name__ == '__main__':
                             help="repogroup to join", default=guess_reponame())
     parser.add_argument("--repourl",
                             help="URL for this repo", default=guess_repourl())
+    parser.add_argument("--consensus", choices=sorted(CONSENSUS_BACKENDS),
+                            help="where to keep consensus refs", default=CONSENSUS)
     parser.add_argument("--etcdroot",
-                            help="etcd root", default=ETCD_ROOT)
+                            help="etcd root, or database file for --consensus=local",
+                            default=ETCD_ROOT)
     parser.add_argument("--etcdprefix",
                             help="prefix for etcd keys", default=ETCD_PREFIX)
+    parser.add_argument("--bundle",
+                            help="bundle file to seed a new repo from on install")
+    parser.add_argument("--noseed", action='store_true',
+                            help="join without fetching the repogroup's objects first")
     parser.add_argument("--logfile",
                             help="file to log to in daemon mode", default="piehole.log")
+    parser.add_argument("--metricsfile",
+                            help="file to write JSON metrics to in daemon mode")
+    parser.add_argument("--remotelimit", type=int,
+                            help="transfers at once per peer host in daemon mode",
+                            default=REMOTE_TRANSFER_LIMIT)
+    parser.add_argument("--bandwidth", action='append', default=[],
+                            metavar="HOST=BYTES",
+                            help="average bytes per second for a peer host in daemon mode; "
+                                 "delays the next transfer, doesn't throttle a running one")
+    parser.add_argument("--registry",
+                            help="file listing the repos served in daemon mode "
+                                 "(default: piehole-registry.db beside --logfile)")
+    parser.add_argument("--root", action='append', default=[],
+                            help="directory to search for repos to serve in daemon mode")
     parser.add_argument("command", choices=['help', 'install', 'check', 'daemon', 'clobber'],
                             help="command")
     args = parser.parse_args()
     if args.command == 'daemon':
-        start_daemon(args.logfile)
+        try:
+            bandwidth = dict((host, int(rate)) for host, rate in
+                             (item.split('=', 1) for item in args.bandwidth))
+        except ValueError:
+            fail("--bandwidth takes HOST=BYTES, for example example.com=1000000")
+        start_daemon(args.logfile, args.metricsfile, args.remotelimit,
+                     bandwidth, args.registry, args.root)
     elif args.command == 'clobber':
         clobber()
     elif args.command == 'install':
-        install(args.repogroup, args.repourl, args.etcdroot, args.etcdprefix)
+        install(args.repogroup, args.repourl, args.etcdroot, args.etcdprefix,
+                not args.noseed, args.bundle, args.consensus)
     elif args.command == 'check':
         try:
             sanity_check()
@@ -1,13 +1,17 @@
 #!/usr/bin/env python3
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
 
+import base64
+import collections
 import contextlib
+import json
 import os
 import shutil
 import signal
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import unittest
 import urllib.parse
@@ -15,8 +19,12 @@ import urllib.request
 import uuid
 
 sys.path.append('.')
-from piehole import run_git, etcd_read, etcd_write, GitFailure, BLANK, \
-                    invoke_daemon, reporef, DAEMON_PORT
+import piehole
+from piehole import run_git, consensus, GitFailure, BLANK, LocalBackend, \
+                    invoke_daemon, reporef, DAEMON_PORT, GitTimeout, \
+                    EtcdV3Backend, TransferScheduler, SCHEDULER_AGING, \
+                    SCHEDULER_RECHECK, RepoRegistry, SanityCheckFailure, \
+                    CONFIG_CACHE
 
 TEST_REPO_COUNT = 3
 
@@ -138,11 +146,19 @@ class TemporaryPieholeDaemon:
         self.returncode = None
         self.root = tempfile.mkdtemp()
         self.logfile = os.path.join(self.root, 'piehole.log')
+        self.metricsfile = os.path.join(self.root, 'metrics.json')
         count = 0
-        self.daemon = subprocess.Popen(["piehole.py", "daemon", "--logfile=%s" % self.logfile])
-        run("curl --connect-timeout 2 -s -d action=ping http://localhost:%d" % DAEMON_PORT)
-        if self.daemon.poll() is None:
-            return
+        self.daemon = subprocess.Popen(["piehole.py", "daemon", "--logfile=%s" % self.logfile,
+                                        "--metricsfile=%s" % self.metricsfile])
+        while self.daemon.poll() is None:
+            try:
+                run("curl --connect-timeout 2 -s -d action=ping http://localhost:%d" % DAEMON_PORT)
+                return
+            except RunError:
+                count += 1
+                if count > 20:
+                    break
+                time.sleep(0.1)
         raise RuntimeError("Failed to start daemon")
    
     def cleanup(self):
@@ -156,6 +172,15 @@ class TemporaryPieholeDaemon:
             fh.seek(0)
             return fh.read()
 
+    def metrics(self):
+        "How many of each metric, counting git metrics by command."
+        counts = collections.Counter()
+        with open(self.metricsfile) as fh:
+            for line in fh:
+                record = json.loads(line)
+                counts[record.get('command', record['metric'])] += 1
+        return counts
+
 
 class PieholeTest(unittest.TestCase):
     def __init__(self, methodname):
@@ -211,14 +236,14 @@ class PieholeTest(unittest.TestCase):
 
     def current_ref(self, ref='refs/heads/master'):
         with in_directory(self.repoa):
-            return etcd_read("%s %s" % (self.repogroup, ref))
+            return consensus().read("%s %s" % (self.repogroup, ref))
 
     def clobber_ref(self, value, ref='refs/heads/master'):
         while self.current_ref(ref) != value:
             with in_directory(self.repoa):
                 while True:
-                    if etcd_write("%s refs/heads/master" % self.repogroup,
-                                  value, self.current_ref(ref)):
+                    if consensus().write("%s refs/heads/master" % self.repogroup,
+                                         value, self.current_ref(ref)):
                         break
 
     def wait_for_replication(self, ref='refs/heads/master'):
@@ -289,7 +314,7 @@ class PieholeTest(unittest.TestCase):
         self.workrepo.push('a')
         self.wait_for_replication()
         with in_directory(self.repoa):
-            etcd_write(self.repogroup, self.repoa.url)
+            consensus().write(self.repogroup, self.repoa.url)
         self.register(omit=self.repob)
         self.workrepo.commit()
         self.workrepo.repeat_push('b')
@@ -299,7 +324,7 @@ class PieholeTest(unittest.TestCase):
 
     def test_ssh(self):
         with in_directory(self.repoa):
-            etcd_write(self.repogroup, self.repoa.url)
+            consensus().write(self.repogroup, self.repoa.url)
         with in_directory(self.repob):
             run("git config piehole.repourl git+ssh://localhost%s" % self.repob.root)
         self.register()
@@ -330,7 +355,7 @@ class PieholeTest(unittest.TestCase):
         with in_directory(self.repob):
             run('rm -rf *')
             run('git init --bare')
-            run("piehole.py install --repogroup=%s" % self.repogroup)
+            run("piehole.py install --noseed --repogroup=%s" % self.repogroup)
         self.workrepo.commit()
         for failcount in range(20):
             try:
@@ -343,6 +368,58 @@ class PieholeTest(unittest.TestCase):
         else:
             raise AssertionError("Out of date repo failed to catch up")
 
+    def test_seed(self):
+        "A repo that joins an active group can take a push right away."
+        self.workrepo.commit()
+        self.workrepo.run_git('tag', 'seeded')
+        self.workrepo.push('a')
+        self.workrepo.push('a', 'seeded')
+        self.wait_for_replication()
+        with in_directory(self.repob):
+            run('rm -rf *')
+            run('git init --bare')
+            run("piehole.py install --repogroup=%s" % self.repogroup)
+        self.assertEqual(self.current_ref(), self.repob.reporef())
+        self.assertIn('seeded', self.repob.run_git('tag'))
+        self.workrepo.commit()
+        self.workrepo.push('b')
+        self.wait_for_replication()
+
+    def test_reseed(self):
+        "Seeding again replaces refs that have diverged from the group."
+        self.workrepo.commit()
+        self.workrepo.push('a')
+        self.wait_for_replication()
+        with in_directory(self.repob):
+            tree = run_git('hash-object', '-t', 'tree', '-w',
+                           '/dev/null').strip()
+            stray = run_git('commit-tree', tree, '-m', 'stray').strip()
+            run_git('update-ref', 'refs/heads/master', stray)
+            run_git('config', 'piehole.state', 'seeding')
+            run("piehole.py install --repogroup=%s" % self.repogroup)
+            self.assertEqual('active', run_git('config', 'piehole.state').strip())
+        self.assertEqual(self.current_ref(), self.repob.reporef())
+
+    def test_push_skipped(self):
+        "A push to peers that already have the commit is skipped."
+        self.workrepo.commit()
+        self.workrepo.push('a')
+        self.wait_for_replication()
+        def counts():
+            # Wait for the daemon's children to finish first.
+            while True:
+                seen = self.pieholed.metrics()
+                time.sleep(1)
+                if self.pieholed.metrics() == seen:
+                    return seen
+        before = counts()
+        invoke_daemon(self.repob.root, 'refs/heads/master', 'push')
+        after = counts()
+        self.assertEqual(before['push'], after['push'])
+        self.assertEqual(before['push_skipped'] + 2, after['push_skipped'])
+        # At most one ls-remote per peer, covering all its refs.
+        self.assertLessEqual(after['ls-remote'] - before['ls-remote'], 2)
+
     def test_clobber(self):
         "Get stuck, then unstick with clobber from one repo"
         self.workrepo.commit()
@@ -382,5 +459,305 @@ class PieholeTest(unittest.TestCase):
         self.workrepo.repeat_push('a')
 
 
+class RunGitTest(unittest.TestCase):
+    "run_git on its own, without etcd or the daemon"
+    def setUp(self):
+        self.repo = TemporaryGitRepo()
+
+    def tearDown(self):
+        self.repo.cleanup()
+
+    def test_separate_streams(self):
+        self.repo.run_git('config', 'alias.both', '!echo out; echo err >&2')
+        self.assertEqual('out\n', self.repo.run_git('both'))
+
+    def test_failure_output(self):
+        self.repo.run_git('config', 'alias.bad', '!echo out; echo err >&2; exit 3')
+        with self.assertRaises(GitFailure) as ctx:
+            self.repo.run_git('bad')
+        self.assertEqual(3, ctx.exception.returncode)
+        self.assertEqual('out\n', ctx.exception.stdout)
+        self.assertEqual('err\n', ctx.exception.stderr)
+
+    def test_progress(self):
+        "Carriage-return progress on stderr keeps only each line's last update."
+        self.repo.run_git('config', 'alias.progress',
+                          '!printf "a 1%%\\ra 50%%\\ra 100%%\\nerr\\r\\n" >&2; exit 1')
+        with in_directory(self.repo):
+            with self.assertRaises(GitFailure) as ctx:
+                run_git('progress', stream=True)
+        self.assertEqual('a 100%\nerr\n', ctx.exception.stderr)
+
+    def test_slot_per_thread(self):
+        "A slot held in this process is not handed out again."
+        saved = piehole.GIT_SLOT_DIR, piehole.GIT_MAX_PROCS
+        piehole.GIT_SLOT_DIR = os.path.join(self.repo.root, 'slots')
+        piehole.GIT_MAX_PROCS = 1
+        try:
+            with piehole.git_slot(True, None):
+                with self.assertRaises(GitTimeout):
+                    with piehole.git_slot(True, time.monotonic() + 0.2):
+                        pass
+        finally:
+            piehole.GIT_SLOT_DIR, piehole.GIT_MAX_PROCS = saved
+
+    def test_timeout(self):
+        "A hung command is killed at its deadline."
+        self.repo.run_git('config', 'alias.hang', '!sleep 30')
+        start = time.time()
+        with in_directory(self.repo):
+            with self.assertRaisesRegex(GitTimeout, 'timed out'):
+                run_git('hang', timeout=0.5)
+        self.assertLess(time.time() - start, 5)
+
+
+class LocalBackendTest(unittest.TestCase):
+    "The SQLite consensus backend, without etcd"
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.backend = LocalBackend(os.path.join(self.root, 'db'), 'test')
+
+    def tearDown(self):
+        cleanup_directory(self.root)
+
+    def test_install_needs_file(self):
+        "Install refuses an etcd URL for local consensus, before any hooks."
+        repo = TemporaryGitRepo('--bare')
+        piehole_py = os.path.abspath('piehole.py')
+        try:
+            with self.assertRaisesRegex(RunError, 'database file'):
+                repo.run("%s install --consensus=local --noseed "
+                         "--repogroup=g" % piehole_py)
+            self.assertFalse(os.path.exists(
+                os.path.join(repo.root, 'hooks', 'update')))
+        finally:
+            repo.cleanup()
+
+    def test_compare_and_swap(self):
+        self.assertIsNone(self.backend.read('g refs/heads/master'))
+        self.assertTrue(self.backend.write('g refs/heads/master', 'a', ''))
+        self.assertFalse(self.backend.write('g refs/heads/master', 'b', ''))
+        self.assertFalse(self.backend.write('g refs/heads/master', 'b', 'c'))
+        self.assertTrue(self.backend.write('g refs/heads/master', 'b', 'a'))
+        self.assertEqual('b', self.backend.read('g refs/heads/master'))
+
+    def test_write_many_is_atomic(self):
+        self.backend.write('g refs/heads/one', 'a')
+        self.assertFalse(self.backend.write_many([
+            ('g refs/heads/one', 'b', 'a'),
+            ('g refs/heads/two', 'b', 'wrong')]))
+        self.assertEqual('a', self.backend.read('g refs/heads/one'))
+        self.assertIsNone(self.backend.read('g refs/heads/two'))
+
+    def test_range(self):
+        self.backend.write_many([('g refs/heads/one', 'a', None),
+                                 ('g refs/tags/two', 'b', None),
+                                 ('h refs/heads/one', 'c', None)])
+        self.assertEqual({'g refs/heads/one': 'a', 'g refs/tags/two': 'b'},
+                         self.backend.range('g '))
+        self.assertEqual({'g refs/heads/one': 'a', 'g refs/heads/two': None},
+                         self.backend.read_many(['g refs/heads/one',
+                                                 'g refs/heads/two']))
+
+
+class EtcdV3BackendTest(unittest.TestCase):
+    "The etcd v3 backend's requests, against a canned gateway"
+    def setUp(self):
+        self.backend = EtcdV3Backend('http://etcd.invalid', 'test')
+        self.backend.call = self.call
+        self.calls = []
+        self.store = {}
+        self.fail_after = None
+
+    def call(self, method, params, timeout=None):
+        self.calls.append((method, params))
+        if self.fail_after is not None and len(self.calls) > self.fail_after:
+            return {'succeeded': False}
+        if 'success' in params and 'request_range' in params['success'][0]:
+            return {'succeeded': True, 'responses': [
+                {'response_range': {'kvs': [
+                    {'key': op['request_range']['key'],
+                     'value': self.store[op['request_range']['key']]}]
+                    if op['request_range']['key'] in self.store else []}}
+                for op in params['success']]}
+        return {'succeeded': True}
+
+    def b64(self, text):
+        return base64.b64encode(text.encode('utf-8')).decode('ascii')
+
+    def test_compare_and_swap(self):
+        "Writes are txns that compare the old value, or creation."
+        self.assertTrue(self.backend.write('g refs/heads/master', 'b', 'a'))
+        self.assertTrue(self.backend.write('g refs/heads/new', 'c', ''))
+        self.assertTrue(self.backend.write('g', 'd'))
+        key = self.b64('test/g refs/heads/master')
+        self.assertEqual([('kv/txn', {
+            'compare': [{'key': key, 'target': 'VALUE', 'result': 'EQUAL',
+                         'value': self.b64('a')}],
+            'success': [{'request_put': {'key': key,
+                                         'value': self.b64('b')}}]})],
+            self.calls[:1])
+        self.assertEqual([{'key': self.b64('test/g refs/heads/new'),
+                           'target': 'CREATE', 'result': 'EQUAL',
+                           'create_revision': 0}],
+                         self.calls[1][1]['compare'])
+        self.assertEqual([], self.calls[2][1]['compare'])
+        self.fail_after = 3
+        self.assertFalse(self.backend.write('g refs/heads/master', 'e', 'a'))
+
+    def test_range(self):
+        "A range read covers every key that starts with the prefix."
+        def call(method, params, timeout=None):
+            self.calls.append((method, params))
+            return {'kvs': [
+                {'key': self.b64('test/g refs/heads/one'),
+                 'value': self.b64('a')},
+                {'key': self.b64('test/g refs/tags/two'),
+                 'value': self.b64('b')}]}
+        self.backend.call = call
+        self.assertEqual({'g refs/heads/one': 'a', 'g refs/tags/two': 'b'},
+                         self.backend.range('g refs/'))
+        self.assertEqual([('kv/range', {'key': self.b64('test/g refs/'),
+                                        'range_end': self.b64('test/g refs0')})],
+                         self.calls)
+
+    def test_read_many_in_batches(self):
+        keys = ['g refs/heads/%d' % i for i in range(300)]
+        self.store[self.b64('test/g refs/heads/7')] = self.b64('a')
+        values = self.backend.read_many(keys)
+        self.assertEqual([128, 128, 44],
+                         [len(params['success']) for _, params in self.calls])
+        self.assertEqual('a', values['g refs/heads/7'])
+        self.assertIsNone(values['g refs/heads/299'])
+        self.assertEqual(300, len(values))
+
+    def test_write_many_in_batches(self):
+        items = [('g refs/heads/%d' % i, 'b', 'a') for i in range(200)]
+        self.assertTrue(self.backend.write_many(items))
+        self.assertEqual([(128, 128), (72, 72)],
+                         [(len(p['compare']), len(p['success']))
+                          for _, p in self.calls])
+        self.calls = []
+        self.fail_after = 0
+        self.assertFalse(self.backend.write_many(items))
+        self.assertEqual(1, len(self.calls))
+
+
+class RegistryTest(unittest.TestCase):
+    "The daemon's list of served repos, without etcd"
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.registry = RepoRegistry(os.path.join(self.root, 'registry'),
+                                     [self.root])
+
+    def tearDown(self):
+        CONFIG_CACHE.clear()
+        cleanup_directory(self.root)
+
+    def bare_repo(self, name):
+        path = os.path.join(self.root, name)
+        os.makedirs(path)
+        run_git('init', '--quiet', '--bare', path)
+        with open(os.path.join(path, 'hooks', 'post-update'), 'w'):
+            pass
+        return path
+
+    def test_scan(self):
+        self.bare_repo('one.git')
+        self.bare_repo('group/two.git')
+        os.makedirs(os.path.join(self.root, 'empty'))
+        self.assertEqual(2, self.registry.scan())
+        self.registry.remove(os.path.join(self.root, 'one.git'))
+        self.assertEqual(1, self.registry.status()['other'])
+        self.assertEqual(2, self.registry.scan())
+        self.assertEqual(0, self.registry.status()['healthy'])
+        cleanup_directory(os.path.join(self.root, 'group'))
+        self.assertEqual(1, self.registry.scan())
+
+    def test_peer_refs(self):
+        "A peer seen with a ref needs no push of the same commit."
+        peer = self.bare_repo('peer.git')
+        CONFIG_CACHE['repogroup'] = 'group'
+        self.assertFalse(self.registry.peer_has(peer, 'refs/heads/master', 'a'))
+        self.registry.confirm(peer, {'refs/heads/master': 'a'})
+        self.assertTrue(self.registry.peer_has(peer, 'refs/heads/master', 'a'))
+        self.assertFalse(self.registry.peer_has(peer, 'refs/heads/master', 'b'))
+        self.assertTrue(self.registry.peer_stale(peer))
+
+    def test_unhealthy(self):
+        path = self.bare_repo('plain.git')
+        self.registry.scan()
+        self.registry.record_transfer(path, [], ['push failed'])
+        with in_directory(path):
+            with self.assertRaisesRegex(SanityCheckFailure, 'logAllRefUpdates'):
+                self.registry.prepare(path)
+        self.assertIn('logAllRefUpdates',
+                      self.registry.status()['problems'][os.path.realpath(path)])
+        self.assertEqual((1, 1, 'push failed'), self.registry.db().execute(
+            "SELECT transfers, failures, last_error FROM repos").fetchone())
+
+
+class SchedulerTest(unittest.TestCase):
+    "Transfer ordering, without etcd or the daemon"
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.scheduler = TransferScheduler(os.path.join(self.root, 'state'),
+                                           remotelimit=1)
+        self.now = time.time()
+
+    def tearDown(self):
+        cleanup_directory(self.root)
+
+    def enqueue(self, klass, peer, age=0):
+        ticket = {'id': uuid.uuid4().hex, 'pid': os.getpid(),
+                  'class': klass, 'peer': peer, 'queued': self.now - age}
+        with self.scheduler.state() as state:
+            state['waiting'].append(ticket)
+        return ticket
+
+    def admit(self, ticket):
+        with self.scheduler.state() as state:
+            return self.scheduler.admit(state, ticket, self.now)
+
+    def test_branch_before_bulk(self):
+        bulk = self.enqueue('bulk', 'a', age=1)
+        branch = self.enqueue('branch', 'a')
+        self.assertFalse(self.admit(bulk))
+        self.assertTrue(self.admit(branch))
+
+    def test_aging(self):
+        "Bulk work that has waited long enough goes ahead of new pushes."
+        bulk = self.enqueue('bulk', 'a', age=3 * SCHEDULER_AGING)
+        branch = self.enqueue('branch', 'a')
+        self.assertFalse(self.admit(branch))
+        self.assertTrue(self.admit(bulk))
+
+    def test_remote_limit(self):
+        first = self.enqueue('branch', 'a')
+        second = self.enqueue('branch', 'a')
+        other = self.enqueue('bulk', 'b')
+        self.assertTrue(self.admit(first))
+        self.assertFalse(self.admit(second))
+        self.assertTrue(self.admit(other))
+        self.assertEqual(1, self.scheduler.status()['branch']['waiting'])
+
+    def test_wake(self):
+        "A waiting transfer starts as soon as the one ahead finishes."
+        started = []
+        def second():
+            with self.scheduler.transfer('branch', 'ssh://a/repo'):
+                started.append(time.monotonic())
+        with self.scheduler.transfer('branch', 'ssh://a/repo'):
+            thread = threading.Thread(target=second)
+            thread.start()
+            while not self.scheduler.status()['branch']['waiting']:
+                time.sleep(0.01)
+            finished = time.monotonic()
+        thread.join()
+        self.assertLess(started[0] - finished, SCHEDULER_RECHECK / 2)
+        self.assertEqual([], [name for name in os.listdir(self.root)
+                              if name != 'state'])
+
+
 if __name__ == '__main__':
     unittest.main()